@@ -1,10 +1,20 @@
 import requests
-from web3 import Web3
-from datetime import datetime
+import asyncio
+import itertools
+import os
+import re
+import tempfile
+from web3 import Web3, AsyncWeb3, AsyncHTTPProvider
+import numpy as np
 import pandas as pd
 import pm4py
-from eth_abi.abi import decode
+from faster_eth_abi.abi import decode
+from faster_eth_abi.exceptions import DecodingError
+from eth_utils import event_abi_to_log_topic
+from eth_utils.abi import collapse_if_tuple
 import json
+from pathlib import Path
+from web3.exceptions import Web3RPCError
 
 # ---------------------------
 # Configuration
@@ -13,8 +23,17 @@ INFURA_PROJECT_ID = ""  # Replace with your Infura Project ID
 ETHERSCAN_API_KEY = ""  # Replace with your Etherscan API Key
 CONTRACT_ADDRESS = ""   # Replace with your target contract address
 LAST_N_BLOCKS = 5       # Number of recent blocks to analyze
+RPC_BATCH_SIZE = 100    # Max requests per JSON-RPC batch (providers cap batch sizes)
+USE_RPC_BATCHING = True # Set to False for providers that penalize batches; fetches in parallel instead
+RPC_CONCURRENCY = 32    # In-flight async block requests when not batching
+LOG_WINDOW_SIZE = 2000  # Blocks per eth_getLogs request (providers cap the range)
+LOG_FETCH_CONCURRENCY = 16  # In-flight eth_getLogs requests
+ABI_CACHE_DIR = Path.home() / ".cache" / "proc_mining" / "abi"  # Verified ABIs are immutable, so cache them on disk
+USE_KNOWN_EVENTS_ONLY = False  # Skip the Etherscan ABI and only decode the KNOWN_EVENTS below
+FILTER_LOGS_BY_ABI = False  # Only fetch logs whose topic0 is in the ABI; drops events emitted via proxies/delegatecall
 
 RPC_URL = f"https://mainnet.infura.io/v3/{INFURA_PROJECT_ID}"
+# Serial calls (head block, batches) go through this client; concurrent fan-outs use make_async_w3
 w3 = Web3(Web3.HTTPProvider(RPC_URL))
 
 # Known event signatures for fallback decoding (e.g., an example event from earlier demonstrations)
@@ -29,13 +48,29 @@ KNOWN_EVENTS = {
     }
     # Add more known event signatures here if desired
 }
+# Topic hash -> known event, so matching logs are decoded without the ABI
+KNOWN_BY_TOPIC = {w3.keccak(text=signature): meta for signature, meta in KNOWN_EVENTS.items()}
 
 # ---------------------------
 # Utility Functions
 # ---------------------------
 
 def get_contract_abi(address, api_key):
-    """Fetch the contract ABI from Etherscan if verified."""
+    """Fetch the contract ABI from Etherscan if verified, using the on-disk cache when possible."""
+    if not Web3.is_address(address):
+        raise ValueError(f"Invalid contract address: {address!r}")
+    # Normalize so the cache key can't contain path separators and differently-cased inputs share an entry
+    address = Web3.to_checksum_address(address).lower()
+    cache_path = ABI_CACHE_DIR / f"ethereum_{address}.json"
+    if cache_path.exists():
+        abi_json = cache_path.read_text()
+        try:
+            json.loads(abi_json)
+            return abi_json
+        except json.JSONDecodeError:
+            # Corrupt entry: drop it and fetch the ABI again
+            cache_path.unlink(missing_ok=True)
+
     url = f"https://api.etherscan.io/api"
     params = {
         "module": "contract",
@@ -47,65 +82,191 @@ def get_contract_abi(address, api_key):
     result = response.json()
 
     if result["status"] == "1":
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file and rename it into place, so an interrupted write never leaves a truncated cache entry
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(result["result"])
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
         return result["result"]
     else:
         return None
 
-def get_event_signature_hash(signature):
-    """Calculate the Keccak hash (topic) of the event signature."""
-    return w3.keccak(text=signature).hex()
+def find_arg(arg_names, name):
+    """Return the position of the named argument, or None if the event has no such argument."""
+    return arg_names.index(name) if name in arg_names else None
+
+def prepare_event(abi_event):
+    """Precompute the input layout of an ABI event, so decoding a log needs no per-log list building."""
+    inputs = abi_event.get('inputs', [])
+    arg_names = [i.get('name', '') for i in inputs]
+
+    # Heuristics for mapping arguments onto the event log, resolved once per event type:
+    # - 'user' is the case_id
+    # - 'step' is the activity
+    # - an integer 'timestamp' replaces the block timestamp
+    timestamp_index = find_arg(arg_names, 'timestamp')
+    if timestamp_index is not None and not re.fullmatch(r'u?int\d*', inputs[timestamp_index]['type']):
+        timestamp_index = None
+
+    return {
+        "name": abi_event['name'],
+        # collapse_if_tuple turns struct inputs ('tuple' + components) into the '(...)' form decode() expects
+        "indexed": [(position, collapse_if_tuple(i)) for position, i in enumerate(inputs) if i.get('indexed')],
+        "non_indexed_positions": [position for position, i in enumerate(inputs) if not i.get('indexed')],
+        "non_indexed_types": [collapse_if_tuple(i) for i in inputs if not i.get('indexed')],
+        "arg_names": arg_names,
+        "case_id_index": find_arg(arg_names, 'user'),
+        "activity_index": find_arg(arg_names, 'step'),
+        "timestamp_index": timestamp_index
+    }
 
-def fetch_logs(address, from_block, to_block):
-    """Fetch logs from the specified block range."""
-    # If you know the exact event signature you want, you can filter by topics. 
-    # Here we do a broad fetch for demonstration (no topics = fetch all events).
-    logs = w3.eth.get_logs({
-        "address": address,
-        "fromBlock": from_block,
-        "toBlock": to_block
-    })
-    return logs
-
-def decode_log(log, abi_events):
-    """Attempt to decode a log using the given ABI event definitions."""
-    for abi_event in abi_events:
-        # Match event by its signature hash
-        event_signature = f"{abi_event['name']}({','.join(i['type'] for i in abi_event['inputs'])})"
-        event_hash = get_event_signature_hash(event_signature)
-        if log['topics'][0].hex() == event_hash:
-            # Decode indexed and non-indexed inputs
-            indexed_inputs = [i for i in abi_event['inputs'] if i['indexed']]
-            non_indexed_inputs = [i for i in abi_event['inputs'] if not i['indexed']]
-
-            # Decode indexed inputs from topics
-            decoded_indexed = []
-            topic_index = 1
-            for inp in indexed_inputs:
-                if inp['type'] == 'address':
-                    decoded_indexed.append("0x" + log['topics'][topic_index].hex()[-40:])
-                else:
-                    decoded_indexed.append(int(log['topics'][topic_index].hex(), 16))
-                topic_index += 1
-
-            # Decode non-indexed from data
-            data_bytes = log['data'] if isinstance(log['data'], (bytes, bytearray)) else bytes.fromhex(log['data'].replace("0x", ""))
-            decoded_non_indexed = []
-            if len(non_indexed_inputs) > 0:
-                arg_types = [i['type'] for i in non_indexed_inputs]
-                decoded_non_indexed = list(decode(arg_types, data_bytes))
-
-            # Combine results
-            final_args = decoded_indexed + decoded_non_indexed
-            return {
-                "event_name": abi_event['name'],
-                "args": final_args,
-                "arg_names": [i['name'] for i in abi_event['inputs']]
-            }
-    return None
-
-def get_block_timestamp(block_number):
-    block = w3.eth.get_block(block_number)
-    return block.timestamp
+def is_hashable_event(abi_event):
+    """Check that an ABI event has a signature topic to match on."""
+    # Anonymous events don't emit a signature topic, and inputs without a type can't be hashed
+    if abi_event.get('anonymous') or not abi_event.get('name'):
+        return False
+    return all(i.get('type') for i in abi_event.get('inputs', []))
+
+def build_event_index(abi_events):
+    """Map each ABI event's topic hash to its prepared layout, computed once per ABI."""
+    return {
+        event_abi_to_log_topic(abi_event): prepare_event(abi_event)
+        for abi_event in abi_events
+        if is_hashable_event(abi_event)
+    }
+
+def is_too_many_results(error):
+    """Check whether an RPC error means the getLogs range matched too many logs."""
+    message = str(error).lower()
+    return "-32005" in message or "too many results" in message or "more than" in message
+
+def make_async_w3():
+    """Build an AsyncWeb3 client, to drive many concurrent RPC calls from one event loop."""
+    return AsyncWeb3(AsyncHTTPProvider(RPC_URL))
+
+async def fetch_log_window(w3a, filter_params, from_block, to_block, semaphore):
+    """Fetch logs for one block window, halving it while the node rejects it as too large."""
+    try:
+        async with semaphore:
+            return await w3a.eth.get_logs({**filter_params, "fromBlock": from_block, "toBlock": to_block})
+    except Web3RPCError as e:
+        if from_block >= to_block or not is_too_many_results(e):
+            raise
+    middle = (from_block + to_block) // 2
+    first, second = await asyncio.gather(
+        fetch_log_window(w3a, filter_params, from_block, middle, semaphore),
+        fetch_log_window(w3a, filter_params, middle + 1, to_block, semaphore)
+    )
+    return first + second
+
+async def gather_logs(filter_params, windows):
+    w3a = make_async_w3()
+    semaphore = asyncio.Semaphore(LOG_FETCH_CONCURRENCY)
+    try:
+        log_lists = await asyncio.gather(*[
+            fetch_log_window(w3a, filter_params, from_block, to_block, semaphore)
+            for from_block, to_block in windows
+        ])
+    finally:
+        await w3a.provider.disconnect()
+    return list(itertools.chain.from_iterable(log_lists))
+
+def fetch_logs(address, from_block, to_block, topic0s=None):
+    """Fetch logs from the specified block range in fixed-size windows fetched concurrently."""
+    filter_params = {"address": address}
+    # Let the node drop events we can't decode (a nested list ORs the topic0 values).
+    # No topics = fetch all events.
+    if topic0s:
+        filter_params["topics"] = [list(topic0s)]
+
+    windows = [
+        (start, min(start + LOG_WINDOW_SIZE - 1, to_block))
+        for start in range(from_block, to_block + 1, LOG_WINDOW_SIZE)
+    ]
+    return asyncio.run(gather_logs(filter_params, windows))
+
+def get_log_data(log):
+    """Return the log's non-indexed data as bytes."""
+    return log['data'] if isinstance(log['data'], (bytes, bytearray)) else bytes.fromhex(log['data'].replace("0x", ""))
+
+def decode_log(log, event_by_topic):
+    """Attempt to decode a log using the prepared ABI events indexed by topic hash."""
+    event = event_by_topic.get(log['topics'][0])
+    if not event or len(log['topics']) - 1 != len(event["indexed"]):
+        # Same topic0 with a different indexed layout (e.g. ERC-721 vs ERC-20 Transfer)
+        return None
+
+    # Args are placed back at their ABI positions, so they line up with arg_names
+    args = [None] * len(event["arg_names"])
+
+    # Decode indexed inputs from topics, working on the raw topic bytes
+    for topic, (position, arg_type) in zip(log['topics'][1:], event["indexed"]):
+        if arg_type == 'address':
+            args[position] = "0x" + topic[-20:].hex()
+        else:
+            args[position] = int.from_bytes(topic, 'big')
+
+    # Decode non-indexed from data
+    if event["non_indexed_types"]:
+        try:
+            decoded = decode(event["non_indexed_types"], get_log_data(log))
+        except DecodingError:
+            return None
+        for position, value in zip(event["non_indexed_positions"], decoded):
+            args[position] = value
+
+    return {
+        "event_name": event["name"],
+        "args": args,
+        "arg_names": event["arg_names"],
+        "case_id_index": event["case_id_index"],
+        "activity_index": event["activity_index"],
+        "timestamp_index": event["timestamp_index"]
+    }
+
+def to_label(value):
+    """Convert a decoded argument to the string PM4Py expects for case ids and activities."""
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + value.hex()
+    return str(value)
+
+async def gather_block_timestamps(block_numbers):
+    w3a = make_async_w3()
+    semaphore = asyncio.Semaphore(RPC_CONCURRENCY)
+
+    async def get_timestamp(block_number):
+        async with semaphore:
+            block = await w3a.eth.get_block(block_number)
+        return block.timestamp
+
+    try:
+        return await asyncio.gather(*[get_timestamp(block_number) for block_number in block_numbers])
+    finally:
+        await w3a.provider.disconnect()
+
+def get_block_timestamps(block_numbers):
+    """Fetch timestamps for many blocks using JSON-RPC batches or parallel requests."""
+    # The set() already dedupes block numbers, so each block is fetched once
+    # however many logs it holds; no separate per-block cache is needed
+    block_numbers = sorted(set(block_numbers))
+    if not USE_RPC_BATCHING:
+        timestamps = asyncio.run(gather_block_timestamps(block_numbers))
+        return dict(zip(block_numbers, timestamps))
+
+    block_timestamps = {}
+    for i in range(0, len(block_numbers), RPC_BATCH_SIZE):
+        chunk = block_numbers[i:i + RPC_BATCH_SIZE]
+        with w3.batch_requests() as batch:
+            batch.add_mapping({w3.eth.get_block: chunk})
+            blocks = batch.execute()
+        for block_number, block in zip(chunk, blocks):
+            block_timestamps[block_number] = block.timestamp
+    return block_timestamps
 
 # ---------------------------
 # Main Flow
@@ -115,78 +276,91 @@ def get_block_timestamp(block_number):
 current_block = w3.eth.block_number
 start_block = max(current_block - LAST_N_BLOCKS, 0)
 
-# 2. Try to fetch ABI from Etherscan
-abi_json = get_contract_abi(CONTRACT_ADDRESS, ETHERSCAN_API_KEY)
+# 2. Try to fetch ABI from Etherscan, unless only the known events are of interest
+abi_json = None
+if not USE_KNOWN_EVENTS_ONLY:
+    abi_json = get_contract_abi(CONTRACT_ADDRESS, ETHERSCAN_API_KEY)
 abi = None
 abi_events = []
 if abi_json:
     abi = json.loads(abi_json) if isinstance(abi_json, str) else abi_json
     # Extract events
     abi_events = [item for item in abi if item.get('type') == 'event']
+event_by_topic = build_event_index(abi_events)
+
+# 3. Fetch logs; all events by default, since a proxy's ABI doesn't list its implementation's events
+if USE_KNOWN_EVENTS_ONLY:
+    topic0s = list(KNOWN_BY_TOPIC)
+elif FILTER_LOGS_BY_ABI and event_by_topic:
+    topic0s = list(event_by_topic.keys() | KNOWN_BY_TOPIC.keys())
+else:
+    topic0s = None
+logs = fetch_logs(CONTRACT_ADDRESS, start_block, current_block, topic0s)
 
-# 3. Fetch logs
-logs = fetch_logs(CONTRACT_ADDRESS, start_block, 'latest')
+# 4. Fetch all block timestamps up front in batched RPC calls
+block_timestamps = get_block_timestamps(log['blockNumber'] for log in logs)
 
-# 4. Decode logs into a DataFrame suitable for process mining
-# We need columns: case_id, activity, timestamp
-data = []
+# 5. Decode logs into a DataFrame suitable for process mining
+# We need columns: case_id, activity, timestamp, built column-wise
+case_ids = []
+activities = []
+block_ts_epochs = []
+event_ts_epochs = []  # 0 where the event carries no timestamp of its own
+has_event_ts = []
 
 for log in logs:
+    block_ts_epochs.append(block_timestamps[log['blockNumber']])
+
+    # Prefer the ABI when it describes the event. KNOWN_EVENTS don't record which arguments
+    # are indexed, so the fast path only applies when every argument is in the log data.
+    known_event = None
+    if log['topics'][0] not in event_by_topic and len(log['topics']) == 1:
+        known_event = KNOWN_BY_TOPIC.get(log['topics'][0])
+    if known_event:
+        # Known layout: decode the data directly and read the prestored argument positions
+        args = decode(known_event["arg_types"], get_log_data(log))
+        case_ids.append(to_label(args[known_event["case_id_index"]]))
+        activities.append(to_label(args[known_event["activity_index"]]))
+        event_ts_epochs.append(args[known_event["timestamp_index"]])
+        has_event_ts.append(True)
+        continue
+
     decoded = None
-    if abi_events:
-        decoded = decode_log(log, abi_events)
+    if event_by_topic:
+        decoded = decode_log(log, event_by_topic)
 
     if not decoded:
         # Can't decode arguments, just store raw
-        # We'll treat the event_name as hex of the topic,
-        # and activity as the event name, timestamp from block
-        block_ts = get_block_timestamp(log['blockNumber'])
         # With no proper decoding, we have no user or step
-        # We'll use the log address as case_id, event hash as activity
-        data.append({
-            "case_id": log['address'],
-            "activity": log['topics'][0].hex(),
-            "timestamp": datetime.fromtimestamp(block_ts)
-        })
-    else:
-        # We have event_name and args. We must figure out how to map them.
-        # Try to find columns for case_id, activity, and timestamp:
-        event_name = decoded["event_name"]
-        args = decoded["args"]
-        arg_names = decoded["arg_names"]
-
-        # Heuristics:
-        # - If 'user' in arg_names, use that as case_id
-        # - If 'step' or 'activity' in arg_names, use as activity
-        # - If 'timestamp' in arg_names, convert from int to datetime
-        # Otherwise fallback to address and block timestamp
-        case_id_value = CONTRACT_ADDRESS
-        activity_value = event_name
-        block_ts = get_block_timestamp(log['blockNumber'])
-        ts_value = datetime.fromtimestamp(block_ts)
-
-        if 'user' in arg_names:
-            user_index = arg_names.index('user')
-            case_id_value = args[user_index]
-
-        if 'step' in arg_names:
-            step_index = arg_names.index('step')
-            activity_value = args[step_index]
-
-        if 'timestamp' in arg_names:
-            timestamp_index = arg_names.index('timestamp')
-            # Ensure the timestamp is int
-            evt_ts = args[timestamp_index]
-            if isinstance(evt_ts, int):
-                ts_value = datetime.fromtimestamp(evt_ts)
-        
-        data.append({
-            "case_id": case_id_value,
-            "activity": activity_value,
-            "timestamp": ts_value
-        })
-
-event_log_df = pd.DataFrame(data)
+        # We'll use the log address as case_id, event hash as activity, timestamp from block
+        case_ids.append(log['address'])
+        activities.append(log['topics'][0].hex())
+        event_ts_epochs.append(0)
+        has_event_ts.append(False)
+        continue
+
+    # The 'user', 'step' and 'timestamp' argument positions were resolved once per event
+    # type from the ABI. Missing ones fall back to the contract address, the event name
+    # and the block timestamp.
+    args = decoded["args"]
+    case_id_index = decoded["case_id_index"]
+    activity_index = decoded["activity_index"]
+    timestamp_index = decoded["timestamp_index"]
+    case_ids.append(to_label(CONTRACT_ADDRESS if case_id_index is None else args[case_id_index]))
+    activities.append(to_label(decoded["event_name"] if activity_index is None else args[activity_index]))
+    event_ts_epochs.append(0 if timestamp_index is None else args[timestamp_index])
+    has_event_ts.append(timestamp_index is not None)
+
+# Prefer the event's own timestamp over the block timestamp, in one vectorized pass
+block_ts_epochs = np.array(block_ts_epochs, dtype=np.int64)
+event_ts_epochs = np.array(event_ts_epochs, dtype=np.int64)
+ts_epochs = np.where(np.array(has_event_ts, dtype=bool), event_ts_epochs, block_ts_epochs)
+
+event_log_df = pd.DataFrame({
+    "case_id": case_ids,
+    "activity": activities,
+    "timestamp": pd.to_datetime(ts_epochs, unit='s', utc=True)
+})
 
 if event_log_df.empty:
     print("No events found for the given contract and range.")
@@ -194,26 +368,37 @@ if event_log_df.empty:
 else:
     print("Event count:", len(event_log_df))
 
-# Prepare the DataFrame for PM4Py
-event_log_df = pm4py.format_dataframe(
-    event_log_df,
-    case_id='case_id',
-    activity_key='activity',
-    timestamp_key='timestamp'
-)
-
-print('Converting logs')
-log = pm4py.convert_to_event_log(event_log_df)
+# Prepare the DataFrame for PM4Py: the timestamp column is already datetime64[ns, UTC],
+# so it only needs PM4Py's standard keys and the (case, timestamp) order format_dataframe
+# would give it. Start/end activities follow row order, and event-supplied timestamps
+# mean the rows aren't time-ordered yet.
+event_log_df = event_log_df.rename(columns={
+    'case_id': 'case:concept:name',
+    'activity': 'concept:name',
+    'timestamp': 'time:timestamp'
+})
+event_log_df = event_log_df.sort_values(['case:concept:name', 'time:timestamp'], kind='stable')
 
 print('mining')
+# PM4Py discovery works on the DataFrame directly, no EventLog conversion needed
 # Apply Alpha Miner
-net, initial_marking, final_marking = pm4py.discover_petri_net_alpha(log)
+net, initial_marking, final_marking = pm4py.discover_petri_net_alpha(
+    event_log_df,
+    case_id_key='case:concept:name',
+    activity_key='concept:name',
+    timestamp_key='time:timestamp'
+)
 
 # Visualize Petri Net
 # pm4py.view_petri_net(net, initial_marking, final_marking)
 
 # Discover and visualize Directly-Follows Graph
-dfg, start_activities, end_activities = pm4py.discover_dfg(log)
+dfg, start_activities, end_activities = pm4py.discover_dfg(
+    event_log_df,
+    case_id_key='case:concept:name',
+    activity_key='concept:name',
+    timestamp_key='time:timestamp'
+)
 pm4py.view_dfg(dfg, start_activities, end_activities)
 
 print("Event Log Data (sample):")
@@ -1,12 +1,25 @@
 import streamlit as st
 import requests
-from web3 import Web3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
+import os
+import tempfile
+import threading
+import itertools
+import aiohttp
+from web3 import Web3, AsyncWeb3, AsyncHTTPProvider
+from web3.providers.rpc.utils import ExceptionRetryConfiguration
 from web3.middleware import ExtraDataToPOAMiddleware
-from datetime import datetime
 import pandas as pd
 import pm4py
 import json
+from pathlib import Path
+from faster_eth_abi.abi import default_codec
+from eth_utils import event_abi_to_log_topic
 from web3._utils.events import get_event_data
+from eth_abi.exceptions import DecodingError
+from web3.exceptions import LogTopicError, MismatchedABI, Web3RPCError
 
 # ---------------------------
 # Configuration
@@ -21,11 +34,34 @@ POLYGON_RPC_URL = f"https://polygon-mainnet.infura.io/v3/{INFURA_PROJECT_ID}"
 ETHERSCAN_URL = "https://api.etherscan.io/api"
 POLYGONSCAN_URL = "https://api.polygonscan.com/api"
 
+RPC_BATCH_SIZE = 100        # Max requests per JSON-RPC batch (providers cap batch sizes)
+USE_RPC_BATCHING = True     # Set to False for providers that penalize batches; fetches in parallel instead
+RPC_CONCURRENCY = 32        # In-flight block requests when not batching
+HTTP_POOL_SIZE = 64         # Pooled connections per chain, kept alive across Streamlit reruns
+LOG_WINDOW_SIZE = 2000      # Blocks per eth_getLogs request (providers cap the range)
+LOG_FETCH_CONCURRENCY = 16  # In-flight eth_getLogs requests
+ABI_CACHE_DIR = Path.home() / ".cache" / "proc_mining" / "abi"  # Verified ABIs are immutable, so cache them on disk
+FILTER_LOGS_BY_ABI = False  # Only fetch logs whose topic0 is in the ABI; drops events emitted via proxies/delegatecall
+
 # ---------------------------
 # Utility Functions
 # ---------------------------
-def get_contract_abi(address, api_url, api_key):
-    """Fetch the contract ABI from Etherscan-like explorer if verified."""
+def get_contract_abi(address, chain, api_url, api_key):
+    """Fetch the contract ABI from Etherscan-like explorer if verified, using the on-disk cache when possible."""
+    if not Web3.is_address(address):
+        raise ValueError(f"Invalid contract address: {address!r}")
+    # Normalize so the cache key can't contain path separators and differently-cased inputs share an entry
+    address = Web3.to_checksum_address(address).lower()
+    cache_path = ABI_CACHE_DIR / f"{chain.lower()}_{address}.json"
+    if cache_path.exists():
+        abi_json = cache_path.read_text()
+        try:
+            json.loads(abi_json)
+            return abi_json
+        except json.JSONDecodeError:
+            # Corrupt entry: drop it and fetch the ABI again
+            cache_path.unlink(missing_ok=True)
+
     params = {
         "module": "contract",
         "action": "getabi",
@@ -36,101 +72,256 @@ def get_contract_abi(address, api_url, api_key):
     result = response.json()
 
     if result["status"] == "1":
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file and rename it into place, so an interrupted write never leaves a truncated cache entry
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(result["result"])
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
         return result["result"]
     else:
         return None
 
-def get_event_signature_hash(signature, w3):
-    """Calculate the Keccak hash (topic) of the event signature."""
-    return w3.keccak(text=signature).hex()
-
-def fetch_logs(address, from_block, to_block, w3):
-    """Fetch logs from the specified block range."""
-    logs = w3.eth.get_logs({
-        "address": address,
-        "fromBlock": from_block,
-        "toBlock": to_block
-    })
-    return logs
-
-def decode_log(log, abi_events, w3):
-    """Attempt to decode a log using the given ABI event definitions."""
-
-    for abi_event in abi_events:
-        try:
-            decoded = get_event_data(w3.codec, abi_event, log)
-            
-            if decoded:
-                event_name = decoded['event']
-                event_args = decoded['args']
-                return {
-                    "event_name": event_name,
-                    "args": list(event_args.values()),
-                    "arg_names": list(event_args.keys())
-                }
-        except:
-            # If it doesn't match this event, just continue to the next
-            pass
-    return None
-
-def get_block_timestamp(block_number, w3):
-    block = w3.eth.get_block(block_number)
-    return block.timestamp
+def make_session():
+    """Create a requests session that pools connections for concurrent RPC calls."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.2)
+    ))
+    return session
 
-def analyze_contract(chain, contract_hash, num_blocks):
+def get_chain_config(chain):
+    """Return the RPC URL, explorer API URL and explorer API key for the chain."""
     if chain == "Ethereum":
-        RPC_URL = ETHEREUM_RPC_URL
-        SCAN_URL = ETHERSCAN_URL
-        SCAN_API_KEY = ETHERSCAN_API_KEY
+        return ETHEREUM_RPC_URL, ETHERSCAN_URL, ETHERSCAN_API_KEY
     else:  # Polygon
-        RPC_URL = POLYGON_RPC_URL
-        SCAN_URL = POLYGONSCAN_URL
-        SCAN_API_KEY = POLYGONSCAN_API_KEY
+        return POLYGON_RPC_URL, POLYGONSCAN_URL, POLYGONSCAN_API_KEY
 
-    w3 = Web3(Web3.HTTPProvider(RPC_URL))
+@st.cache_resource
+def get_w3(chain):
+    """Build the Web3 client for the chain once and share it across Streamlit reruns."""
+    rpc_url, _, _ = get_chain_config(chain)
+    w3 = Web3(Web3.HTTPProvider(rpc_url, session=make_session()))
     w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+    return w3
+
+@st.cache_resource
+def get_async_w3(chain):
+    """Build the AsyncWeb3 client for the chain once, on its own long-lived event loop.
+
+    The client's aiohttp session is bound to that loop, so its pooled connections survive across
+    Streamlit reruns. Use run_async to drive coroutines on it.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    rpc_url, _, _ = get_chain_config(chain)
+
+    async def connect():
+        w3a = AsyncWeb3(AsyncHTTPProvider(rpc_url, exception_retry_configuration=ExceptionRetryConfiguration(
+            errors=(aiohttp.ClientError, asyncio.TimeoutError),
+            retries=3,
+            backoff_factor=0.2,
+            method_allowlist=["eth_getLogs", "eth_getBlockByNumber"]
+        )))
+        w3a.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+        await w3a.provider.cache_async_session(session)
+        return w3a
+
+    w3a = asyncio.run_coroutine_threadsafe(connect(), loop).result()
+    return loop, w3a
+
+def run_async(chain, make_coroutine):
+    """Run make_coroutine(w3a) on the chain's long-lived event loop and wait for the result."""
+    loop, w3a = get_async_w3(chain)
+    return asyncio.run_coroutine_threadsafe(make_coroutine(w3a), loop).result()
+
+def is_hashable_event(abi_event):
+    """Check that an ABI event has a signature topic to match on."""
+    # Anonymous events don't emit a signature topic, and inputs without a type can't be hashed
+    if abi_event.get('anonymous') or not abi_event.get('name'):
+        return False
+    return all(i.get('type') for i in abi_event.get('inputs', []))
+
+def build_event_index(abi_events):
+    """Map each ABI event's topic hash to its definition, computed once per ABI."""
+    return {
+        event_abi_to_log_topic(abi_event): abi_event
+        for abi_event in abi_events
+        if is_hashable_event(abi_event)
+    }
+
+def is_too_many_results(error):
+    """Check whether an RPC error means the getLogs range matched too many logs."""
+    message = str(error).lower()
+    return "-32005" in message or "too many results" in message or "more than" in message
+
+async def fetch_log_window(w3a, filter_params, from_block, to_block, semaphore):
+    """Fetch logs for one block window, halving it while the node rejects it as too large."""
+    try:
+        async with semaphore:
+            return await w3a.eth.get_logs({**filter_params, "fromBlock": from_block, "toBlock": to_block})
+    except Web3RPCError as e:
+        if from_block >= to_block or not is_too_many_results(e):
+            raise
+    middle = (from_block + to_block) // 2
+    first, second = await asyncio.gather(
+        fetch_log_window(w3a, filter_params, from_block, middle, semaphore),
+        fetch_log_window(w3a, filter_params, middle + 1, to_block, semaphore)
+    )
+    return first + second
+
+async def gather_logs(w3a, filter_params, windows):
+    semaphore = asyncio.Semaphore(LOG_FETCH_CONCURRENCY)
+    log_lists = await asyncio.gather(*[
+        fetch_log_window(w3a, filter_params, from_block, to_block, semaphore)
+        for from_block, to_block in windows
+    ])
+    return list(itertools.chain.from_iterable(log_lists))
+
+def fetch_logs(address, from_block, to_block, chain, topic0s=None):
+    """Fetch logs from the specified block range in fixed-size windows fetched concurrently."""
+    filter_params = {"address": address}
+    # Let the node drop events we can't decode (a nested list ORs the topic0 values)
+    if topic0s:
+        filter_params["topics"] = [list(topic0s)]
+
+    windows = [
+        (start, min(start + LOG_WINDOW_SIZE - 1, to_block))
+        for start in range(from_block, to_block + 1, LOG_WINDOW_SIZE)
+    ]
+    return run_async(chain, lambda w3a: gather_logs(w3a, filter_params, windows))
+
+def decode_log(log, event_by_topic):
+    """Attempt to decode a log using the ABI events indexed by topic hash."""
+    abi_event = event_by_topic.get(log['topics'][0])
+    if not abi_event:
+        return None
+
+    try:
+        decoded = get_event_data(default_codec, abi_event, log)
+    except (MismatchedABI, LogTopicError, DecodingError):
+        # Same signature as the ABI event, but the topic count or data doesn't fit its inputs;
+        # fall back to the raw topic rather than aborting the analysis
+        return None
+
+    event_args = decoded['args']
+    return {
+        "event_name": decoded['event'],
+        "args": list(event_args.values()),
+        "arg_names": list(event_args.keys())
+    }
+
+def to_label(value):
+    """Convert a decoded argument to the string PM4Py expects for case ids and activities."""
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + value.hex()
+    return str(value)
+
+async def gather_block_timestamps(w3a, block_numbers):
+    semaphore = asyncio.Semaphore(RPC_CONCURRENCY)
+
+    async def get_timestamp(block_number):
+        async with semaphore:
+            block = await w3a.eth.get_block(block_number)
+        return block.timestamp
+
+    return await asyncio.gather(*[get_timestamp(block_number) for block_number in block_numbers])
+
+def get_block_timestamps(block_numbers, chain):
+    """Fetch timestamps for many blocks using JSON-RPC batches or parallel requests."""
+    # The set() already dedupes block numbers, so each block is fetched once
+    # however many logs it holds; no separate per-block cache is needed
+    block_numbers = sorted(set(block_numbers))
+    if not USE_RPC_BATCHING:
+        timestamps = run_async(chain, lambda w3a: gather_block_timestamps(w3a, block_numbers))
+        return dict(zip(block_numbers, timestamps))
+
+    w3 = get_w3(chain)
+    block_timestamps = {}
+    for i in range(0, len(block_numbers), RPC_BATCH_SIZE):
+        chunk = block_numbers[i:i + RPC_BATCH_SIZE]
+        with w3.batch_requests() as batch:
+            batch.add_mapping({w3.eth.get_block: chunk})
+            blocks = batch.execute()
+        for block_number, block in zip(chunk, blocks):
+            block_timestamps[block_number] = block.timestamp
+    return block_timestamps
+
+@st.cache_data(ttl=15)
+def mine_process_graph(chain, contract_hash, num_blocks, head_window):
+    """Mine the contract's DFG and return it as PNG bytes.
+
+    head_window only keys the cache: results are reused until the head moves into the next num_blocks window.
+    """
+    w3 = get_w3(chain)
+    _, SCAN_URL, SCAN_API_KEY = get_chain_config(chain)
 
     current_block = w3.eth.block_number
     start_block = max(current_block - num_blocks, 0)
 
-    abi_json = get_contract_abi(contract_hash, SCAN_URL, SCAN_API_KEY)
+    abi_json = get_contract_abi(contract_hash, chain, SCAN_URL, SCAN_API_KEY)
     abi = None
     abi_events = []
     if abi_json:
         abi = json.loads(abi_json) if isinstance(abi_json, str) else abi_json
         abi_events = [item for item in abi if item.get('type') == 'event']
+    event_by_topic = build_event_index(abi_events)
 
-    logs = fetch_logs(contract_hash, start_block, 'latest', w3)
+    topic0s = list(event_by_topic) if FILTER_LOGS_BY_ABI else None
+    logs = fetch_logs(contract_hash, start_block, current_block, chain, topic0s)
 
-    data = []
+    block_timestamps = get_block_timestamps((log['blockNumber'] for log in logs), chain)
+
+    case_ids = []
+    activities = []
+    block_numbers = []
     for log in logs:
-        decoded = decode_log(log, abi_events, w3) if abi_events else None
-        block_ts = get_block_timestamp(log['blockNumber'], w3)
+        decoded = decode_log(log, event_by_topic) if event_by_topic else None
         case_id_value = log['address']
         activity_value = log['topics'][0].hex()
-        ts_value = datetime.fromtimestamp(block_ts)
 
         if decoded:
-            case_id_value = decoded["args"][0]
+            case_id_value = to_label(decoded["args"][0])
             activity_value = decoded["event_name"]
 
-        data.append({
-            "case_id": case_id_value,
-            "activity": activity_value,
-            "timestamp": ts_value
-        })
+        case_ids.append(case_id_value)
+        activities.append(activity_value)
+        block_numbers.append(log['blockNumber'])
 
-    event_log_df = pd.DataFrame(data)
+    # Convert each distinct block timestamp once, then look the rows up by block number
+    ts_by_block = pd.to_datetime(pd.Series(block_timestamps), unit='s', utc=True)
+    event_log_df = pd.DataFrame({
+        "case_id": case_ids,
+        "activity": activities,
+        "timestamp": ts_by_block.reindex(block_numbers).reset_index(drop=True)
+    })
     if event_log_df.empty:
         raise ValueError("No events found for the given contract and range.")
 
-    event_log_df = pm4py.format_dataframe(event_log_df, case_id='case_id', activity_key='activity', timestamp_key='timestamp')
-    log = pm4py.convert_to_event_log(event_log_df)
-
-    dfg, start_activities, end_activities = pm4py.discover_dfg(log)
+    # Timestamps are already datetime64[ns, UTC], so only PM4Py's column names and the
+    # (case, timestamp) order format_dataframe would give are needed; start/end activities follow row order
+    event_log_df = event_log_df.rename(columns={'case_id': 'case:concept:name', 'activity': 'concept:name', 'timestamp': 'time:timestamp'})
+    event_log_df = event_log_df.sort_values(['case:concept:name', 'time:timestamp'], kind='stable')
+    dfg, start_activities, end_activities = pm4py.discover_dfg(
+        event_log_df,
+        case_id_key='case:concept:name',
+        activity_key='concept:name',
+        timestamp_key='time:timestamp'
+    )
     img_path = "output_dfg.png"
     pm4py.save_vis_dfg(dfg, start_activities, end_activities, img_path)
-    return img_path
+    return Path(img_path).read_bytes()
+
+def analyze_contract(chain, contract_hash, num_blocks):
+    head_block = get_w3(chain).eth.block_number
+    return mine_process_graph(chain, contract_hash, num_blocks, head_block // num_blocks)
 
 # ---------------------------
 # Streamlit Application
@@ -145,7 +336,7 @@ num_blocks = st.number_input("Enter Number of Blocks", min_value=1, max_value=10
 if st.button("Analyze"):
     try:
         st.write("Fetching and analyzing data...")
-        img_path = analyze_contract(chain, contract_hash, num_blocks)
-        st.image(img_path, caption="Mined Process Graph", use_container_width=True)
+        img = analyze_contract(chain, contract_hash, num_blocks)
+        st.image(img, caption="Mined Process Graph", use_container_width=True)
     except Exception as e:
         st.error(f"Error: {e}")